@@ -5,8 +5,18 @@ Similar to Swagger UI - Interactive API interface for querying Sentinel products
 """
 
 import streamlit as st
+import hashlib
+import orjson
+import pandas as pd
 import requests
-from datetime import datetime, date
+import time
+import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import NamedTuple, Optional
 import io
 
 # Configure page
@@ -18,6 +28,31 @@ st.set_page_config(
 
 # Constants
 ODATA_API_URL = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products"
+REQUEST_TIMEOUT = 120
+QUERY_CACHE_TTL = 300
+PAGE_SIZE = 1000
+MAX_PAGE_WORKERS = 8
+QUERY_CACHE_MAX_ENTRIES = 8
+
+# Shared HTTP session so pagination requests reuse pooled TLS connections
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+    )
+)
+_SESSION.headers.update({
+    "User-Agent": f"eopf-copernicus-query ({requests.utils.default_user_agent()})",
+    # Advertise brotli/gzip; only encodings urllib3 can decode are listed
+    "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"]
+})
 
 PRODUCT_CONFIGS = {
     'sentinel2_l2a': {
@@ -54,22 +89,10 @@ PRODUCT_CONFIGS = {
     }
 }
 
-def build_odata_filter(config, bbox, start_date, end_date, tile=None):
-    """Build OData filter string"""
+def _product_filter(config):
+    """Build the static collection/product part of the OData filter"""
     collection_filter = f"Collection/Name eq '{config['collection']}'"
     
-    # Spatial filter
-    bbox_polygon = (
-        f"POLYGON(("
-        f"{bbox['west']} {bbox['south']},"
-        f"{bbox['east']} {bbox['south']},"
-        f"{bbox['east']} {bbox['north']},"
-        f"{bbox['west']} {bbox['north']},"
-        f"{bbox['west']} {bbox['south']}"
-        f"))"
-    )
-    spatial_filter = f"OData.CSC.Intersects(area=geography'SRID=4326;{bbox_polygon}')"
-    
     # Collection-specific filters
     if config['collection'] == 'SENTINEL-2':
         type_filter = (
@@ -78,118 +101,237 @@ def build_odata_filter(config, bbox, start_date, end_date, tile=None):
             f"att/OData.CSC.StringAttribute/Value eq '{config['product_type']}'"
             f")"
         )
-        if tile:
-            tile_filter = f"contains(Name,'{tile}')"
-            odata_filter = f"{collection_filter} and {type_filter} and {tile_filter} and {spatial_filter}"
-        else:
-            odata_filter = f"{collection_filter} and {type_filter} and {spatial_filter}"
-    else:
-        instrument_filter = (
-            f"Attributes/OData.CSC.StringAttribute/any("
-            f"att:att/Name eq 'instrumentShortName' and "
-            f"att/OData.CSC.StringAttribute/Value eq '{config['instrument']}'"
-            f")"
-        )
-        name_filter = f"contains(Name,'{config['product_type']}')"
-        odata_filter = f"{collection_filter} and {instrument_filter} and {name_filter} and {spatial_filter}"
+        return f"{collection_filter} and {type_filter}"
     
-    # Temporal filter
-    start_time = f"{start_date}T00:00:00.000Z"
-    end_time = f"{end_date}T23:59:59.999Z"
-    temporal_filter = f"ContentDate/Start ge {start_time} and ContentDate/Start le {end_time}"
-    odata_filter = f"{odata_filter} and {temporal_filter}"
+    instrument_filter = (
+        f"Attributes/OData.CSC.StringAttribute/any("
+        f"att:att/Name eq 'instrumentShortName' and "
+        f"att/OData.CSC.StringAttribute/Value eq '{config['instrument']}'"
+        f")"
+    )
+    name_filter = f"contains(Name,'{config['product_type']}')"
+    return f"{collection_filter} and {instrument_filter} and {name_filter}"
+
+# Product filters depend only on PRODUCT_CONFIGS, so build them once at import
+PRODUCT_FILTERS = {key: _product_filter(config) for key, config in PRODUCT_CONFIGS.items()}
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def build_odata_filter(product_key, bbox, start_date, end_date, tile=None, online_only=False):
+    """Build OData filter string for a (west, south, east, north) bbox"""
+    product_filter = PRODUCT_FILTERS[product_key]
+    if tile and PRODUCT_CONFIGS[product_key]['collection'] == 'SENTINEL-2':
+        product_filter = f"{product_filter} and contains(Name,'{tile}')"
     
-    return odata_filter
+    # Spatial filter
+    west, south, east, north = bbox
+    bbox_polygon = f"POLYGON(({west} {south},{east} {south},{east} {north},{west} {north},{west} {south}))"
+    
+    # Combine with spatial and temporal filters
+    return (
+        f"{product_filter} and "
+        f"OData.CSC.Intersects(area=geography'SRID=4326;{bbox_polygon}') and "
+        f"ContentDate/Start ge {start_date}T00:00:00.000Z and "
+        f"ContentDate/Start le {end_date}T23:59:59.999Z"
+        f"{' and Online eq true' if online_only else ''}"
+    )
 
-def search_products(odata_filter, max_products=None, progress_callback=None):
-    """Search products via OData API"""
+def fetch_json(url, params=None):
+    """Fetch an OData page and parse it straight from the response stream"""
+    with _SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return orjson.loads(response.raw.read())
+
+def normalize_odata_filter(odata_filter):
+    """Sort top-level 'and' clauses so equivalent filters share a cache key"""
+    clauses = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(odata_filter):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and odata_filter.startswith(' and ', i):
+            clauses.append(odata_filter[start:i])
+            start = i + len(' and ')
+    clauses.append(odata_filter[start:])
+    return " and ".join(sorted(clauses))
+
+def fetch_products(odata_filter, max_products=None, newest_first=False):
+    """Fetch all pages of an OData query, raising on request errors"""
     params = {
         "$filter": odata_filter,
-        "$orderby": "ContentDate/Start asc",
-        "$top": min(max_products, 1000) if max_products else 1000,
-        "$expand": "Attributes"
+        "$orderby": f"ContentDate/Start {'desc' if newest_first else 'asc'}",
+        "$top": min(max_products, PAGE_SIZE) if max_products else PAGE_SIZE,
+        "$select": "Name,ContentDate,ContentLength,Online,S3Path",
+        "$expand": "Attributes($select=Name,Value;$filter=Name eq 'S3Path')",
+        "$count": "true"
     }
     
-    all_products = []
+    result = fetch_json(ODATA_API_URL, params=params)
+    all_products = result.get('value', [])
     
-    try:
-        response = requests.get(ODATA_API_URL, params=params, timeout=120)
-        response.raise_for_status()
-        result = response.json()
-        products = result.get('value', [])
-        all_products.extend(products)
-        
-        if progress_callback:
-            progress_callback(f"Found {len(products)} products in initial query")
-        
-        # Handle pagination
-        next_link = result.get('@odata.nextLink')
-        page_count = 1
-        
+    total_count = result.get('@odata.count')
+    next_link = result.get('@odata.nextLink')
+    
+    # Without a total count, fall back to following nextLink page by page
+    if total_count is None:
         while next_link and (max_products is None or len(all_products) < max_products):
-            page_count += 1
-            if progress_callback:
-                progress_callback(f"Fetching page {page_count}... (total so far: {len(all_products)})")
-            
-            response = requests.get(next_link, timeout=120)
-            response.raise_for_status()
-            result = response.json()
-            products = result.get('value', [])
-            
-            if max_products:
-                remaining = max_products - len(all_products)
-                products = products[:remaining]
-            
-            all_products.extend(products)
+            # Request only the remainder rather than a full page that gets trimmed
+            remaining = max_products - len(all_products) if max_products else PAGE_SIZE
+            if remaining < PAGE_SIZE:
+                result = fetch_json(ODATA_API_URL, {**params, "$skip": len(all_products), "$top": remaining})
+            else:
+                result = fetch_json(next_link)
+            all_products.extend(result.get('value', []))
             next_link = result.get('@odata.nextLink')
         
-        return all_products
-        
+        return all_products[:max_products] if max_products else all_products
+    
+    # Remaining pages are independent $skip windows, fetched concurrently;
+    # the last window's $top is trimmed so nothing past the cap is requested
+    target = total_count if max_products is None else min(total_count, max_products)
+    page_size = len(all_products)
+    if not next_link or not page_size or page_size >= target:
+        return all_products[:target]
+    
+    del params["$count"]
+    offsets = range(page_size, target, page_size)
+    
+    with ThreadPoolExecutor(max_workers=MAX_PAGE_WORKERS) as executor:
+        futures = {
+            offset: executor.submit(
+                fetch_json,
+                ODATA_API_URL,
+                {**params, "$skip": offset, "$top": min(page_size, target - offset)}
+            )
+            for offset in offsets
+        }
+        for offset in offsets:
+            all_products.extend(futures[offset].result().get('value', []))
+    
+    return all_products[:target]
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def fetch_products_cached(filter_key, max_products, newest_first, _odata_filter):
+    """Cached (fetched_at, products); the normalized filter, cap and order form the key"""
+    # No Streamlit calls here: they would be replayed on cache hits
+    return time.monotonic(), fetch_products(_odata_filter, max_products, newest_first)
+
+def search_products(odata_filter, max_products=None, progress_callback=None, newest_first=False):
+    """Search products via OData API"""
+    filter_key = normalize_odata_filter(odata_filter)
+    cache_key = (hashlib.sha256(filter_key.encode()).hexdigest(), max_products, newest_first)
+    query_cache = st.session_state.setdefault('query_cache', {})
+    now = time.monotonic()
+    
+    # Expired entries are dropped; fresh ones move to the end so eviction is LRU
+    cached = query_cache.pop(cache_key, None)
+    if cached is not None and now - cached[0] < QUERY_CACHE_TTL:
+        query_cache[cache_key] = cached
+        if progress_callback:
+            progress_callback("Using cached results from an identical query")
+        return cached[1]
+    
+    if progress_callback:
+        progress_callback("Fetching products from the catalogue...")
+    
+    try:
+        fetched_at, all_products = fetch_products_cached(
+            filter_key,
+            max_products,
+            newest_first,
+            odata_filter
+        )
     except Exception as e:
         if progress_callback:
             progress_callback(f"Error: {str(e)}")
         return []
-
-def extract_product_info(products):
-    """Extract product information including S3Path"""
-    product_list = []
     
-    for product in products:
-        product_name = product.get('Name', '')
-        
-        # Extract acquisition date
-        content_date = product.get('ContentDate', {})
-        start_str = content_date.get('Start', '')
-        if start_str:
-            acquisition_date = datetime.fromisoformat(start_str.replace('Z', '+00:00'))
-        else:
-            acquisition_date = None
-        
-        # Extract S3Path
-        s3_path = None
-        if 'Attributes' in product and product['Attributes']:
-            for attr in product['Attributes']:
-                if attr.get('Name') == 'S3Path':
-                    s3_path = attr.get('Value')
-                    break
-        
-        if not s3_path and 'S3Path' in product:
-            s3_path = product['S3Path']
-        
-        size = product.get('ContentLength', 0)
-        
-        product_list.append({
-            'product_name': product_name,
-            'acquisition_date': acquisition_date,
-            'datetime': start_str,
-            'online': product.get('Online', False),
-            'size_bytes': size,
-            'size_mb': round(size / (1024 * 1024), 2) if size else 0,
-            's3_path': s3_path
-        })
+    # Keep only fresh, recently used queries to bound session memory
+    for key in [key for key, (cached_at, _) in query_cache.items() if now - cached_at >= QUERY_CACHE_TTL]:
+        del query_cache[key]
+    query_cache[cache_key] = (fetched_at, all_products)
+    while len(query_cache) > QUERY_CACHE_MAX_ENTRIES:
+        query_cache.pop(next(iter(query_cache)))
     
-    product_list.sort(key=lambda x: x['acquisition_date'] if x['acquisition_date'] else datetime.min)
-    return product_list
+    return all_products
+
+class ProductRow(NamedTuple):
+    """Raw fields extracted from one OData product"""
+    product_name: str
+    datetime: str
+    online: bool
+    size_bytes: int
+    s3_path: Optional[str]
+
+def _extract_s3path(attributes):
+    """Return the S3Path value from a product's Attributes list"""
+    if not isinstance(attributes, list):
+        return None
+    return next((attr.get('Value') for attr in attributes if attr.get('Name') == 'S3Path'), None)
+
+def extract_product_info(products):
+    """Extract product information including S3Path into a DataFrame"""
+    # One compact tuple per product; dates and sizes are derived vectorised below
+    rows = [
+        ProductRow(
+            product_name=product.get('Name', ''),
+            datetime=(product.get('ContentDate') or {}).get('Start', ''),
+            online=bool(product.get('Online', False)),
+            size_bytes=product.get('ContentLength') or 0,
+            s3_path=_extract_s3path(product.get('Attributes')) or product.get('S3Path') or None
+        )
+        for product in products
+    ]
+    
+    product_list = pd.DataFrame.from_records(rows, columns=ProductRow._fields)
+    product_list.insert(1, 'acquisition_date', pd.to_datetime(
+        product_list['datetime'], utc=True, errors='coerce', format='ISO8601'
+    ))
+    product_list.insert(5, 'size_mb', product_list['size_bytes'].div(1024 * 1024).round(2))
+    
+    # Pages already arrive in $orderby order; only move undated products to the end
+    dated = product_list['acquisition_date'].notna()
+    if dated.all():
+        return product_list
+    return pd.concat([product_list[dated], product_list[~dated]], ignore_index=True)
+
+def iter_detailed_lines(products):
+    """Yield the lines of the detailed product list one at a time"""
+    for i, p in enumerate(products.itertuples(index=False), 1):
+        date_str = p.acquisition_date.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(p.acquisition_date) else 'N/A'
+        yield f"{i}. {p.product_name}"
+        yield f"   Date: {date_str}"
+        yield f"   Size: {p.size_mb if p.size_bytes else 0} MB"
+        if pd.notna(p.s3_path):
+            yield f"   Path: {p.s3_path}"
+        yield ""
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, max_entries=16, show_spinner=False)
+def build_paths_content(results_id, _products):
+    """Encode the /eodata/ paths download once per result set"""
+    return "\n".join(_products['s3_path'].dropna()).encode()
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, max_entries=16, show_spinner=False)
+def build_detailed_content(results_id, _products):
+    """Encode the detailed download once per result set"""
+    return b"\n".join(line.encode() for line in iter_detailed_lines(_products))
+
+@st.cache_data(show_spinner=False)
+def product_docs():
+    """Pre-render expander labels and markdown for the supported products"""
+    return [
+        (
+            f"**{config['name']}** - {config['description']}",
+            f"- **Collection**: {config['collection']}\n"
+            f"- **Product Type**: {config['product_type']}\n"
+            f"- **Instrument**: {config['instrument']}\n"
+            f"- **Requires Tile**: {'Yes' if config['requires_tile'] else 'No'}"
+        )
+        for config in PRODUCT_CONFIGS.values()
+    ]
 
 # UI Layout
 st.title("🛰️ Copernicus Data Space Product Query")
@@ -284,6 +426,16 @@ with st.sidebar:
         value=None,
         help="Limit number of products (leave empty for all)"
     )
+    online_only = st.checkbox(
+        "Online only",
+        value=False,
+        help="Only return products that are immediately available for download"
+    )
+    newest_first = st.checkbox(
+        "Newest first",
+        value=False,
+        help="Query the most recent products first, so Max Products keeps the latest ones"
+    )
 
 # Main content area
 tab1, tab2, tab3 = st.tabs(["🔍 Query", "📊 Results", "ℹ️ API Info"])
@@ -305,20 +457,32 @@ with tab1:
     if west != 0 or east != 0 or south != 0 or north != 0:
         bbox = {'west': west, 'south': south, 'east': east, 'north': north}
         odata_filter = build_odata_filter(
-            product_config, 
-            bbox, 
+            product_key, 
+            (west, south, east, north), 
             start_date.isoformat(), 
             end_date.isoformat(),
-            tile
+            tile,
+            online_only
         )
         
         with st.expander("🔧 View OData Filter"):
             st.code(odata_filter, language="text")
+        
+        # Identifies the query so an unchanged re-run can skip the network
+        query_hash = hashlib.blake2b(
+            f"{odata_filter}|{max_products}|{newest_first}".encode(), digest_size=16
+        ).digest()
     
     # Query button
     if st.button("🚀 Execute Query", type="primary", use_container_width=True):
         if west == 0 and east == 0 and south == 0 and north == 0:
             st.error("Please specify a valid bounding box")
+        elif (
+            query_hash == st.session_state.get('last_query_hash')
+            and 'products' in st.session_state
+            and time.monotonic() - st.session_state.get('last_query_time', float('-inf')) < QUERY_CACHE_TTL
+        ):
+            st.info("🔁 Query unchanged since the last run - showing the existing results in the 'Results' tab")
         else:
             # Execute query
             with st.spinner("Querying Copernicus Data Space..."):
@@ -330,7 +494,8 @@ with tab1:
                 products = search_products(
                     odata_filter, 
                     max_products=max_products,
-                    progress_callback=progress_update
+                    progress_callback=progress_update,
+                    newest_first=newest_first
                 )
                 
                 if products:
@@ -341,13 +506,18 @@ with tab1:
                     
                     # Store in session state
                     st.session_state['products'] = product_list
+                    st.session_state['results_id'] = uuid.uuid4().hex
+                    st.session_state['last_query_hash'] = query_hash
+                    st.session_state['last_query_time'] = time.monotonic()
                     st.session_state['query_config'] = {
                         'product': product_config['name'],
                         'collection': product_config['collection'],
                         'bbox': bbox,
                         'start_date': start_date.isoformat(),
                         'end_date': end_date.isoformat(),
-                        'tile': tile
+                        'tile': tile,
+                        'online_only': online_only,
+                        'newest_first': newest_first
                     }
                     
                     st.info("📊 Switch to 'Results' tab to view and download products")
@@ -357,36 +527,40 @@ with tab1:
 with tab2:
     st.header("Query Results")
     
-    if 'products' in st.session_state and st.session_state['products']:
+    if st.session_state.get('products') is not None and not st.session_state['products'].empty:
         products = st.session_state['products']
         config = st.session_state.get('query_config', {})
+        results_id = st.session_state.get('results_id')
         
         # Summary statistics
         col1, col2, col3, col4 = st.columns(4)
         with col1:
             st.metric("Total Products", len(products))
         with col2:
-            total_size_gb = sum(p['size_bytes'] for p in products) / (1024**3)
+            total_size_gb = products['size_bytes'].sum() / (1024**3)
             st.metric("Total Size", f"{total_size_gb:.2f} GB")
         with col3:
-            dates = [p['acquisition_date'] for p in products if p['acquisition_date']]
-            if dates:
-                st.metric("Date Range", f"{min(dates).date()} to {max(dates).date()}")
+            dates = products['acquisition_date'].dropna()
+            if not dates.empty:
+                st.metric("Date Range", f"{dates.min().date()} to {dates.max().date()}")
         with col4:
-            online_count = sum(1 for p in products if p['online'])
+            online_count = int(products['online'].sum())
             st.metric("Online", f"{online_count}/{len(products)}")
         
         # Preview table
         st.subheader("Product Preview")
-        preview_data = []
-        for i, p in enumerate(products[:50], 1):
-            preview_data.append({
-                '#': i,
-                'Product Name': p['product_name'][:60] + '...' if len(p['product_name']) > 60 else p['product_name'],
-                'Date': p['acquisition_date'].strftime('%Y-%m-%d') if p['acquisition_date'] else 'N/A',
-                'Size (MB)': p['size_mb'],
-                'Online': '✅' if p['online'] else '❌'
-            })
+        st.caption(
+            f"Ordered by acquisition date, {'newest' if config.get('newest_first') else 'oldest'} first"
+        )
+        preview = products.head(50)
+        names = preview['product_name']
+        preview_data = pd.DataFrame({
+            '#': range(1, len(preview) + 1),
+            'Product Name': names.where(names.str.len() <= 60, names.str.slice(0, 60) + '...'),
+            'Date': preview['acquisition_date'].dt.strftime('%Y-%m-%d').fillna('N/A'),
+            'Size (MB)': preview['size_mb'],
+            'Online': preview['online'].map({True: '✅', False: '❌'})
+        })
         
         st.dataframe(preview_data, use_container_width=True, height=400)
         
@@ -405,13 +579,13 @@ with tab2:
             st.caption("One path per line (compact format)")
             
             # Generate paths-only content
-            paths_content = "\n".join([p['s3_path'] for p in products if p.get('s3_path')])
+            paths_content = build_paths_content(results_id, products)
             
             st.download_button(
                 label="📄 Download Paths (.txt)",
                 data=paths_content,
                 file_name=f"{config.get('product', 'products').replace(' ', '_')}_eodata_paths.txt",
-                mime="text/plain",
+                mime="text/plain; charset=utf-8",
                 use_container_width=True
             )
         
@@ -420,23 +594,13 @@ with tab2:
             st.caption("Includes name, date, size, and path")
             
             # Generate detailed content
-            detailed_lines = []
-            for i, p in enumerate(products, 1):
-                date_str = p['acquisition_date'].strftime('%Y-%m-%d %H:%M:%S') if p['acquisition_date'] else 'N/A'
-                detailed_lines.append(f"{i}. {p['product_name']}")
-                detailed_lines.append(f"   Date: {date_str}")
-                detailed_lines.append(f"   Size: {p['size_mb']} MB")
-                if p.get('s3_path'):
-                    detailed_lines.append(f"   Path: {p['s3_path']}")
-                detailed_lines.append("")
-            
-            detailed_content = "\n".join(detailed_lines)
+            detailed_content = build_detailed_content(results_id, products)
             
             st.download_button(
                 label="📄 Download Detailed (.txt)",
                 data=detailed_content,
                 file_name=f"{config.get('product', 'products').replace(' ', '_')}_detailed.txt",
-                mime="text/plain",
+                mime="text/plain; charset=utf-8",
                 use_container_width=True
             )
         
@@ -468,14 +632,9 @@ with tab3:
     ### Supported Products
     """)
     
-    for key, config in PRODUCT_CONFIGS.items():
-        with st.expander(f"**{config['name']}** - {config['description']}"):
-            st.markdown(f"""
-            - **Collection**: {config['collection']}
-            - **Product Type**: {config['product_type']}
-            - **Instrument**: {config['instrument']}
-            - **Requires Tile**: {'Yes' if config['requires_tile'] else 'No'}
-            """)
+    for label, details in product_docs():
+        with st.expander(label):
+            st.markdown(details)
     
     st.markdown("""
     ### Output Formats